@@ -1,18 +1,130 @@
 import asyncio
 import os
-import json
-from typing import Optional, List
-from contextlib import AsyncExitStack
+import sys
+import threading
+from typing import Optional, List, Dict, Tuple
+from contextlib import AsyncExitStack, suppress
 from datetime import datetime
 import re
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from common import HTTP2, json_dumps, json_loads
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+
 load_dotenv()
 
+# 服务器脚本后缀与启动命令的对应关系，.py 用 python，.js 用 node
+SCRIPT_COMMANDS = {".py": "python", ".js": "node"}
+
+# 提取大模型返回中 ``` 或 ```json 代码块包裹的内容
+FENCE_RE = re.compile(r"```(?:json)?\s*([\s\S]+?)\s*```")
+
+# 生成文件名时把查询中的空格、斜杠、标点等替换为下划线
+SLUG_RE = re.compile(r"[^\w\-]+")
+SEARCH_DIR = "./search_results"
+
+# 设置 MCP_DEBUG 环境变量时才打印提交给大模型的工具定义
+DEBUG = __debug__ and bool(os.getenv("MCP_DEBUG"))
+
+# 大模型连接保活间隔（秒），保证用户输入期间连接不被服务端回收
+KEEPALIVE_INTERVAL = 30
+
+
+def placeholder_key(val) -> Optional[str]:
+    # 参数值形如 {{工具名}} 时返回引用的工具名，否则返回 None
+    if isinstance(val, str) and len(val) >= 4 and val[:2] == "{{" and val[-2:] == "}}":
+        return val[2:-2].strip()
+    return None
+
+
+def plan_waves(tool_plan: List[dict], md_filename: str) -> Tuple[List[List[int]], List[Dict[str, int]]]:
+    """
+    根据步骤间的依赖把工具调用链分成若干批次，同一批次内的步骤互不依赖。
+
+    依赖来源：
+    - {{工具名}} 占位符：引用在它之前、最近一次调用该工具的步骤，与顺序执行时的语义一致；
+      引用不存在（或只出现在之后）的工具名时保持原样，不产生依赖。
+    - 报告文件：写同一文件名（未指定时为 md_filename）的 analyze_sentiment 按顺序执行；
+      send_email_with_attachment 的附件由之前的 analyze_sentiment 生成，需排在它们之后。
+
+    返回:
+        waves: 每个批次包含的步骤下标，按执行顺序排列
+        step_refs: 每个步骤中 占位工具名 -> 被引用步骤下标 的映射
+    """
+    levels = []
+    step_refs = []
+    latest = {}
+    report_writers = {}
+    for idx, step in enumerate(tool_plan):
+        refs = {}
+        for val in step["arguments"].values():
+            ref_key = placeholder_key(val)
+            if ref_key in latest:
+                refs[ref_key] = latest[ref_key]
+        deps = set(refs.values())
+
+        if step["name"] == "analyze_sentiment":
+            report = step["arguments"].get("filename") or md_filename
+            if report in report_writers:
+                deps.add(report_writers[report])
+            report_writers[report] = idx
+        elif step["name"] == "send_email_with_attachment":
+            deps.update(report_writers.values())
+
+        level = max((levels[dep] + 1 for dep in deps), default=0)
+        levels.append(level)
+        step_refs.append(refs)
+        latest[step["name"]] = idx
+
+    waves = [[] for _ in range(max(levels, default=-1) + 1)]
+    for idx, level in enumerate(levels):
+        waves[level].append(idx)
+    return waves, step_refs
+
+
+def read_stdin_lines(loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+    """
+    在后台守护线程中逐行读取标准输入，并投递到事件循环的队列中，读到 EOF 时投递 None。
+
+    直接读取 sys.stdin 底层的原始流，不经过缓冲层：线程阻塞时不持有任何锁，
+    Ctrl-C 退出时解释器既不需要等待该线程，也不会因 stdin 缓冲锁被占用而崩溃。
+    原始流在 POSIX 上等同于 os.read；在 Windows 控制台上是 Python 的控制台层（PEP 528），
+    返回 UTF-8 字节（此时 sys.stdin.encoding 也是 utf-8），而不是控制台代码页（如 cp936）的字节。
+    """
+    raw = sys.stdin.buffer.raw
+    encoding = sys.stdin.encoding or "utf-8"
+    buffer = b""
+    while True:
+        try:
+            chunk = raw.read(4096)
+        except OSError:
+            chunk = b""
+        if chunk:
+            buffer += chunk
+            *complete, buffer = buffer.split(b"\n")
+            lines = [line.decode(encoding, errors="replace").rstrip("\r") for line in complete]
+        else:
+            lines = [buffer.decode(encoding, errors="replace")] if buffer else []
+            lines.append(None)
+        for line in lines:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, line)
+            except RuntimeError:
+                # 事件循环已关闭，程序正在退出
+                return
+        if not chunk:
+            return
+
 
 class MCPClient:
+    # 固定实例属性，减少聊天循环中频繁访问属性时的字典查找
+    __slots__ = (
+        "exit_stack", "openai_api_key", "base_url", "model", "client", "session",
+        "stdio", "write", "_http", "_keepalive_task",
+        "_available_tools", "_system_prompt", "_stdin_lines"
+    )
 
     def __init__(self):
         self.exit_stack = AsyncExitStack()
@@ -21,19 +133,25 @@ class MCPClient:
         self.model = os.getenv("MODEL")
         if not self.openai_api_key:
             raise ValueError("未找到 API Key，请在 .env 文件中设置 DASHSCOPE_API_KEY")
-        self.client = OpenAI(api_key=self.openai_api_key, base_url=self.base_url)
+        # 长期复用的连接池，每轮规划请求直接复用已建立的连接
+        # keepalive_expiry 需长于保活间隔，否则 httpx 默认 5 秒后就会回收空闲连接
+        self._http = httpx.AsyncClient(
+            http2=HTTP2,
+            limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=KEEPALIVE_INTERVAL * 2)
+        )
+        self.client = AsyncOpenAI(api_key=self.openai_api_key, base_url=self.base_url, http_client=self._http)
+        self._keepalive_task: Optional[asyncio.Task] = None
         self.session: Optional[ClientSession] = None
+        self._available_tools: List[dict] = []
+        self._system_prompt: Optional[dict] = None
+        self._stdin_lines: Optional[asyncio.Queue] = None
 
     async def connect_to_server(self, server_script_path: str):
-        # 对服务器脚本进行判断，只允许是 .py 或 .js
-        is_python = server_script_path.endswith('.py')
-        is_js = server_script_path.endswith('.js')
-        if not (is_python or is_js):
+        # 根据服务器脚本后缀确定启动命令，只允许是 .py 或 .js
+        command = SCRIPT_COMMANDS.get(os.path.splitext(server_script_path)[1])
+        if command is None:
             raise ValueError("服务器脚本必须是 .py 或 .js 文件")
 
-        # 确定启动命令，.py 用 python，.js 用 node
-        command = "python" if is_python else "node"
-
         # 构造 MCP 所需的服务器参数，包含启动命令、脚本路径参数、环境变量（为 None 表示默认）
         server_params = StdioServerParameters(command=command, args=[server_script_path], env=None)
 
@@ -46,16 +164,10 @@ class MCPClient:
         # 初始化会话
         await self.session.initialize()
 
-        # 获取工具列表并打印
+        # 获取工具列表并缓存，连接建立后工具集合固定，无需每次查询重新获取
         response = await self.session.list_tools()
         tools = response.tools
-        print("\n已连接到服务器，支持以下工具:", [tool.name for tool in tools])
-
-    async def process_query(self, query: str) -> str:
-        messages = [{"role": "user", "content": query}]
-        response = await self.session.list_tools()
-
-        available_tools = [
+        self._available_tools = [
             {
                 "type": "function",
                 "function": {
@@ -63,54 +175,108 @@ class MCPClient:
                     "description": tool.description,
                     "input_schema": tool.inputSchema
                 }
-            } for tool in response.tools
+            } for tool in tools
         ]
+        tool_list_text = "\n".join([
+            f"- {tool['function']['name']}: {tool['function']['description']}"
+            for tool in self._available_tools
+        ])
+        self._system_prompt = {
+            "role": "system",
+            "content": (
+                "你是一个智能任务规划助手，用户会给出一句自然语言请求。\n"
+                "你只能从以下工具中选择（严格使用工具名称）：\n"
+                f"{tool_list_text}\n"
+                "如果多个工具需要串联，后续步骤中可以使用 {{上一步工具名}} 占位。\n"
+                "返回格式：JSON 数组，每个对象包含 name 和 arguments 字段。\n"
+                "不要返回自然语言，不要使用未列出的工具名。"
+            )
+        }
+        print("\n已连接到服务器，支持以下工具:", [tool.name for tool in tools])
 
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        md_filename = f"search_{query}_{timestamp}.md"
-        md_path = os.path.join("./search_results", md_filename)
-
-        query = query.strip() + f" [md_filename={md_filename}] [md_path={md_path}]"
-        messages = [{"role": "user", "content": query}]
-
-        tool_plan = await self.plan_tool_usage(query, available_tools)
-        tool_outputs = {}
+        # 后台定期访问大模型服务，预先建立并保持连接
+        self._keepalive_task = asyncio.create_task(self.keepalive())
 
+    async def keepalive(self):
+        while True:
+            try:
+                await self._http.head(str(self.client.base_url))
+            except Exception:
+                # 保活失败不影响正常请求，下个周期继续尝试
+                pass
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
 
-        for step in tool_plan:
-            tool_name = step["name"]
-            tool_args = step["arguments"]
+    async def process_query(self, query: str) -> str:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        slug = SLUG_RE.sub("_", query.strip())[:64]
+        md_filename = f"search_{slug}_{timestamp}.md"
+        md_path = f"{SEARCH_DIR}/{md_filename}"
+
+        query = query.strip() + f" [md_filename={md_filename}] [md_path={md_path}] [timestamp={timestamp}]"
+
+        tool_plan = await self.plan_tool_usage(query, self._available_tools)
+        step_outputs = {}
+
+        # 按步骤依赖分成若干批，同一批内互不依赖，可以并发调用
+        waves, step_refs = plan_waves(tool_plan, md_filename)
+        for wave in waves:
+            calls = []
+            for idx in wave:
+                tool_name = tool_plan[idx]["name"]
+                refs = step_refs[idx]
+                # 一次遍历解析占位符，生成新的参数字典，不在遍历时修改原字典
+                tool_args = {
+                    key: step_outputs[refs[ref_key]] if (ref_key := placeholder_key(val)) in refs else val
+                    for key, val in tool_plan[idx]["arguments"].items()
+                }
 
-            for key, val in tool_args.items():
-                if isinstance(val, str) and val.startswith("{{") and val.endswith("}}"):
-                    ref_key = val.strip("{} ")
-                    resolved_val = tool_outputs.get(ref_key, val)
-                    tool_args[key] = resolved_val
+                if tool_name == "analyze_sentiment" and "filename" not in tool_args:
+                    tool_args["filename"] = md_filename
+                if tool_name == "analyze_sentiment" and "timestamp" not in tool_args:
+                    tool_args["timestamp"] = timestamp
+                if tool_name == "send_email_with_attachment" and "attachment_path" not in tool_args:
+                    tool_args["attachment_path"] = md_path
 
-            if tool_name == "analyze_sentiment" and "filename" not in tool_args:
-                tool_args["filename"] = md_filename
-            if tool_name == "send_email_with_attachment" and "attachment_path" not in tool_args:
-                tool_args["attachment_path"] = md_path
+                calls.append((tool_name, tool_args))
 
-            result = await self.session.call_tool(tool_name, tool_args)
+            # 任一调用失败时取消同批次的其他调用，并把第一个错误抛给上层
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    tasks = [tg.create_task(self.session.call_tool(name, args)) for name, args in calls]
+            except ExceptionGroup as eg:
+                raise eg.exceptions[0] from eg
 
-            tool_outputs[tool_name] = result.content[0].text
-            messages.append({
-                "role": "tool",
-                "tool_call_id": tool_name,
-                "content": result.content[0].text
-            })
+            for idx, task in zip(wave, tasks):
+                step_outputs[idx] = task.result().content[0].text
 
         result_messages = "文档已生成并保存在: " + md_path
 
         return result_messages
 
+    async def read_input(self, prompt: str) -> str:
+        # 异步版 input()：读取线程在首次调用时启动，之后一直复用
+        if self._stdin_lines is None:
+            self._stdin_lines = asyncio.Queue()
+            threading.Thread(
+                target=read_stdin_lines,
+                args=(asyncio.get_running_loop(), self._stdin_lines),
+                daemon=True
+            ).start()
+
+        print(prompt, end="", flush=True)
+        line = await self._stdin_lines.get()
+        if line is None:
+            # 保留 EOF 标记，后续调用同样抛出 EOFError
+            self._stdin_lines.put_nowait(None)
+            raise EOFError
+        return line
+
     async def chat_loop(self):
         print("\n🤖 MCP 客户端已启动！输入 'quit' 退出")
 
         while True:
             try:
-                query = input("\nInput: ").strip()
+                query = (await self.read_input("\nInput: ")).strip()
                 if query.lower() == 'quit':
                     break
 
@@ -121,51 +287,42 @@ class MCPClient:
                 print(f"\n⚠️ 发生错误: {str(e)}")
 
     async def plan_tool_usage(self, query: str, tools: List[dict]) -> List[dict]:
-        print("\n📤 提交给大模型的工具定义:")
-        print(json.dumps(tools, ensure_ascii=False, indent=2))
-        tool_list_text = "\n".join([
-            f"- {tool['function']['name']}: {tool['function']['description']}"
-            for tool in tools
-        ])
-        system_prompt = {
-            "role": "system",
-            "content": (
-                "你是一个智能任务规划助手，用户会给出一句自然语言请求。\n"
-                "你只能从以下工具中选择（严格使用工具名称）：\n"
-                f"{tool_list_text}\n"
-                "如果多个工具需要串联，后续步骤中可以使用 {{上一步工具名}} 占位。\n"
-                "返回格式：JSON 数组，每个对象包含 name 和 arguments 字段。\n"
-                "不要返回自然语言，不要使用未列出的工具名。"
-            )
-        }
+        if DEBUG:
+            print("\n📤 提交给大模型的工具定义:")
+            print(json_dumps(tools))
 
         planning_messages = [
-            system_prompt,
+            self._system_prompt,
             {"role": "user", "content": query}
         ]
 
-        response = self.client.chat.completions.create(
+        response = await self.client.chat.completions.create(
             model=self.model,
             messages=planning_messages,
             extra_body={"enable_thinking": False},
             stream=False
         )
         content = response.choices[0].message.content.strip()
-        match = re.search(r"```(?:json)?\\s*([\s\S]+?)\\s*```", content)
+        match = FENCE_RE.search(content)
         if match:
             json_text = match.group(1)
         else:
             json_text = content
 
         try:
-            plan = json.loads(json_text)
+            plan = json_loads(json_text)
             return plan if isinstance(plan, list) else []
         except Exception as e:
             print(f"❌ 工具调用链规划失败: {e}\n原始返回: {content}")
             return []
 
     async def cleanup(self):
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._keepalive_task
         await self.exit_stack.aclose()
+        await self.client.close()
 
 
 async def main():
@@ -179,5 +336,11 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # 安装了 uvloop 时使用 libuv 事件循环，否则退回标准 asyncio（如 Windows）
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
 
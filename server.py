@@ -1,17 +1,80 @@
+import asyncio
 import os
-import json
+import re
+import sys
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime
 import httpx
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import Context, FastMCP
 from dotenv import load_dotenv
-from openai import OpenAI
+from common import HTTP2, json_dumps, json_loads
+from openai import AsyncOpenAI
 
 load_dotenv()
 
-mcp = FastMCP("NewsServer")
+# 空闲连接保留时间（秒）。httpx 默认只保留 5 秒，而两次搜索通常来自不同轮对话，间隔远大于此
+HTTP_KEEPALIVE_EXPIRY = 300
+
+
+def new_http_client() -> httpx.AsyncClient:
+    # 带长连接池的 HTTP 客户端，跨请求复用连接，避免每次搜索重新 TCP+TLS 握手
+    return httpx.AsyncClient(
+        http2=HTTP2,
+        timeout=httpx.Timeout(10.0),
+        limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+    )
+
+
+@asynccontextmanager
+async def lifespan(server: FastMCP):
+    # 每次 Server.run 各自创建并关闭连接池，通过 lifespan 上下文交给工具使用，
+    # 避免 SSE / streamable-http 下某个会话结束时关掉其他会话仍在使用的连接池
+    async with new_http_client() as http:
+        yield {"http": http}
+
+
+mcp = FastMCP("NewsServer", lifespan=lifespan)
+
+# 模块级复用的异步 LLM 客户端，避免阻塞事件循环并复用底层连接池
+_aclient = None
+_MODEL = os.getenv("MODEL")
+
+
+def get_aclient() -> AsyncOpenAI:
+    # 首次调用时创建，未配置 API Key 时不影响服务启动及其他工具
+    global _aclient
+    if _aclient is None:
+        _aclient = AsyncOpenAI(api_key=os.getenv("DASHSCOPE_API_KEY"), base_url=os.getenv("BASE_URL"))
+    return _aclient
+
+
+REPORT_DIR = "./sentiment_reports"
+# 报告目录只需创建一次，避免每次调用都访问文件系统
+_dir_ready = False
+
+# 客户端传入的时间戳格式：YYYYMMDD_HHMMSS
+TIMESTAMP_RE = re.compile(r"(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})")
+
+# 舆情分析报告模板，只有分析时间、原始文本和分析结果随调用变化
+REPORT_TEMPLATE = """# 舆情分析报告
+
+**分析时间：** {ts}
+
+---
+
+## 📥 原始文本
+
+{text}
+
+---
+
+## 📊 分析结果
+
+{result}
+"""
 
 @mcp.tool()
-async def search_google(keyword: str) -> str:
+async def search_google(keyword: str, ctx: Context = None) -> str:
     """
     使用 Serper API（Google Search 封装）根据关键词搜索内容，返回前5条标题、简单描述和链接。
 
@@ -33,9 +96,14 @@ async def search_google(keyword: str) -> str:
     }
     payload = {"q": keyword}
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=payload)
-        data = response.json()
+    async with AsyncExitStack() as stack:
+        if ctx is None:
+            # 直接调用（如 debug_search）时没有 MCP 会话，临时创建一个客户端
+            http = await stack.enter_async_context(new_http_client())
+        else:
+            http = ctx.request_context.lifespan_context["http"]
+        response = await http.post(url, headers=headers, json=payload)
+        data = json_loads(response.content)
 
     if "news" not in data:
         return "❌ 未获取到搜索结果"
@@ -50,66 +118,69 @@ async def search_google(keyword: str) -> str:
 
     return (
         f"✅ 已获取与 [{keyword}] 相关的 Google 新闻：\n"
-        f"{json.dumps(articles, ensure_ascii=False, indent=2)}\n"
+        f"{json_dumps(articles)}\n"
     )
 
 @mcp.tool()
-async def analyze_sentiment(text: str, filename: str) -> str:
+async def analyze_sentiment(text: str, filename: str, timestamp: str = "") -> str:
     """
     对传入的一段文本内容进行情感分析，并保存为指定名称的 Markdown 文件。
 
     参数:
         text (str): 新闻描述或文本内容
         filename (str): 保存的 Markdown 文件名（不含路径）
+        timestamp (str): 分析时间，格式 YYYYMMDD_HHMMSS，为空时取当前时间
 
     返回:
         str: 完整文件路径
     """
 
-    openai_key = os.getenv("DASHSCOPE_API_KEY")
-    model = os.getenv("MODEL")
-    client = OpenAI(api_key=openai_key, base_url=os.getenv("BASE_URL"))
-
     prompt = f"请对以下新闻内容进行情绪倾向分析，并说明原因：\n\n{text}"
 
-    response = client.chat.completions.create(
-        model=model,
+    response = await get_aclient().chat.completions.create(
+        model=_MODEL,
         messages=[{"role": "user", "content": prompt}],
         extra_body={"enable_thinking": False},
         stream=False
     )
     result = response.choices[0].message.content.strip()
 
-    markdown = f"""# 舆情分析报告
-
-**分析时间：** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+    # 优先使用客户端传入的时间戳，与搜索结果文件名保持一致
+    timestamp = (timestamp or "").strip()
+    match = TIMESTAMP_RE.fullmatch(timestamp)
+    if match is None:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        match = TIMESTAMP_RE.fullmatch(timestamp)
+    analyzed_at = "{}-{}-{} {}:{}:{}".format(*match.groups())
 
----
-
-## 📥 原始文本
+    markdown = REPORT_TEMPLATE.format(ts=analyzed_at, text=text, result=result)
 
-{text}
-
----
-
-## 📊 分析结果
-
-{result}
-"""
-
-    output_dir = "./sentiment_reports"
-    os.makedirs(output_dir, exist_ok=True)
+    global _dir_ready
+    if not _dir_ready:
+        os.makedirs(REPORT_DIR, exist_ok=True)
+        _dir_ready = True
 
     if not filename:
-        filename = f"sentiment_{datetime.now().strftime('%Y%m%d_%H%M%S')}.md"
+        filename = f"sentiment_{timestamp}.md"
 
-    file_path = os.path.join(output_dir, filename)
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write(markdown)
+    file_path = os.path.join(REPORT_DIR, filename)
+    # 文件写入放到线程中执行，避免慢速文件系统阻塞事件循环
+    await asyncio.to_thread(_write_report, file_path, markdown.encode("utf-8"))
 
     return file_path
 
 
+def _write_report(path: str, data: bytes):
+    # 报告通常只有几 KB，直接用底层 fd 写入，省去缓冲 I/O 层的额外开销
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
 async def debug_sentiment_analysis():
     print("--- 🚀 开始调试 analyze_sentiment ---")
 
@@ -150,16 +221,24 @@ async def debug_search():
 
 
 if __name__ == "__main__":
-    print("===================================================")
-    print(f"🚀 服务 [NewsServer] 正在启动...")
-    print(f"🛠️  已注册工具:")
+    # stdout 是 MCP stdio 传输通道，启动信息只能输出到 stderr
+    print("===================================================", file=sys.stderr)
+    print(f"🚀 服务 [NewsServer] 正在启动...", file=sys.stderr)
+    print(f"🛠️  已注册工具:", file=sys.stderr)
     
     for tool_name in mcp._tool_manager._tools.keys():
-        print(f"    - {tool_name}")
+        print(f"    - {tool_name}", file=sys.stderr)
         
-    print("===================================================")
-    print(f"✅ [NewsServer] MCP 服务已就绪 (transport='stdio')")
-    mcp.run(transport='stdio')
+    print("===================================================", file=sys.stderr)
+    print(f"✅ [NewsServer] MCP 服务已就绪 (transport='stdio')", file=sys.stderr)
+
+    # 安装了 uvloop 时使用 libuv 事件循环，否则退回标准 asyncio（如 Windows）
+    try:
+        import uvloop
+    except ImportError:
+        mcp.run(transport='stdio')
+    else:
+        uvloop.run(mcp.run_stdio_async())
 
 
     # import asyncio